@@ -1,63 +1,102 @@
+import asyncio
 import os
-from fastapi import FastAPI, HTTPException, Request
+import time
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr, Field
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 from typing import Optional, Literal
 from datetime import datetime, timezone
+from email.message import EmailMessage
+from bson import ObjectId  # type: ignore
 
-from database import create_document, db
+from database import db
 from schemas import PrepaidCardPurchase
 
 # Optional Stripe support
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 PAYMENT_PROVIDER: Literal["stripe", "mock"] = "stripe" if STRIPE_SECRET_KEY else "mock"
 
-app = FastAPI(title="Lavandería & Vending API")
+stripe = None
+if STRIPE_SECRET_KEY:
+    import requests
+    import stripe  # type: ignore
+
+    stripe.api_key = STRIPE_SECRET_KEY
+    # Reuse one keep-alive session with a bounded pool so checkout calls
+    # don't pay a fresh TCP+TLS handshake per request
+    _stripe_session = requests.Session()
+    _stripe_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=20))
+    stripe.default_http_client = stripe.http_client.RequestsClient(session=_stripe_session, verify_ssl_certs=True)
+
+# Environment is fixed for the process lifetime; resolve the lookups once
+_FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+_HAS_DATABASE_URL = bool(os.getenv("DATABASE_URL"))
+_HAS_DATABASE_NAME = bool(os.getenv("DATABASE_NAME"))
+
+app = FastAPI(title="Lavandería & Vending API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=(_FRONTEND_URL,),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=("GET", "POST"),
+    allow_headers=("Content-Type", "Authorization"),
 )
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Backend operativo", "payment_provider": PAYMENT_PROVIDER}
 
 
+# /test gets hammered by liveness probes; rebuild the payload (one Mongo
+# round-trip) at most once per TTL window
+_TEST_CACHE_TTL = 30.0
+_TEST_CACHE = {"ts": 0.0, "payload": None}
+
+# Pre-interned status strings and base payload for /test; the env-derived
+# fields never change at runtime, so they are baked into the template
+_STATUS_SET = "✅ Set"
+_STATUS_NOT_SET = "❌ Not Set"
+_DB_AVAILABLE = "✅ Available"
+_DB_CONNECTED_OK = "✅ Connected & Working"
+_DB_NOT_INITIALIZED = "⚠️ Available but not initialized"
+_DEFAULT_TEST_RESPONSE = {
+    "backend": "✅ Running",
+    "database": "❌ Not Available",
+    "database_url": _STATUS_SET if _HAS_DATABASE_URL else _STATUS_NOT_SET,
+    "database_name": _STATUS_SET if _HAS_DATABASE_NAME else _STATUS_NOT_SET,
+    "connection_status": "Not Connected",
+    "collections": []
+}
+
+
 @app.get("/test")
-def test_database():
-    response = {
-        "backend": "✅ Running",
-        "database": "❌ Not Available",
-        "database_url": None,
-        "database_name": None,
-        "connection_status": "Not Connected",
-        "collections": []
-    }
+async def test_database():
+    cached_at = _TEST_CACHE["ts"]
+    if _TEST_CACHE["payload"] is not None and time.monotonic() - cached_at < _TEST_CACHE_TTL:
+        return _TEST_CACHE["payload"]
+
+    response = {**_DEFAULT_TEST_RESPONSE}
 
     try:
         if db is not None:
-            response["database"] = "✅ Available"
-            response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
+            response["database"] = _DB_AVAILABLE
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
-                response["database"] = "✅ Connected & Working"
+                response["database"] = _DB_CONNECTED_OK
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
         else:
-            response["database"] = "⚠️ Available but not initialized"
+            response["database"] = _DB_NOT_INITIALIZED
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    _TEST_CACHE["ts"] = time.monotonic()
+    _TEST_CACHE["payload"] = response
 
     return response
 
@@ -70,13 +109,38 @@ class PricingConfig(BaseModel):
     payment_provider: Literal["stripe", "mock"] = PAYMENT_PROVIDER
 
 
-@app.get("/api/config", response_model=PricingConfig)
-def get_config():
-    return PricingConfig()
+# Pricing is static for the lifetime of the process; build it once instead of
+# re-running Pydantic construction on every request
+_CONFIG = PricingConfig()
+_TOPUP_SET = frozenset(_CONFIG.topup_options)
+
+# The set of valid checkout payloads is fixed by topup_options, so build each
+# amount's Stripe line_items once at import instead of per request
+_LINE_ITEMS_CACHE = {
+    amount: [
+        {
+            "price_data": {
+                "currency": _CONFIG.currency,
+                "product_data": {"name": f"Tarjeta Prepago + recarga {amount}€"},
+                "unit_amount": (_CONFIG.card_issue_price + amount) * 100,
+            },
+            "quantity": 1,
+        },
+    ]
+    for amount in _CONFIG.topup_options
+}
+
+
+@app.get("/api/config", response_model=None)
+async def get_config() -> PricingConfig:
+    return _CONFIG
 
 
 # ------- PURCHASE FLOW --------
 class CreateCheckoutPayload(BaseModel):
+    # Bounded string parsing guards against pathological inputs on the hot path
+    model_config = ConfigDict(str_strip_whitespace=True, str_max_length=256, extra="forbid")
+
     name: str
     email: EmailStr
     phone: str
@@ -91,8 +155,18 @@ class CheckoutResponse(BaseModel):
     purchase_id: Optional[str] = None
 
 
-def _send_confirmation_email(to_email: str, subject: str, content: str) -> None:
-    # Placeholder email sender: logs to console; can be replaced with SMTP provider using env vars
+# Optional SMTP delivery: configure via env vars; without SMTP_HOST emails are
+# logged to console as before
+_SMTP_HOST = os.getenv("SMTP_HOST")
+_SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+_SMTP_USER = os.getenv("SMTP_USER")
+_SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+_SMTP_FROM = os.getenv("SMTP_FROM", _SMTP_USER or "no-reply@localhost")
+
+_email_queue: "asyncio.Queue[tuple[str, str, str]]" = asyncio.Queue()
+
+
+def _log_email(to_email: str, subject: str, content: str) -> None:
     print("=== EMAIL CONFIRMATION (log) ===")
     print("To:", to_email)
     print("Subject:", subject)
@@ -100,16 +174,114 @@ def _send_confirmation_email(to_email: str, subject: str, content: str) -> None:
     print("=== END EMAIL ===")
 
 
-@app.post("/api/prepaid/create-checkout", response_model=CheckoutResponse)
-def create_checkout(payload: CreateCheckoutPayload, request: Request):
-    config = PricingConfig()
-    if payload.amount not in config.topup_options:
+async def _smtp_connect():
+    # Open and authenticate a fresh SMTP connection; returns None on failure
+    # so callers can fall back to console logging instead of dying
+    import aiosmtplib  # type: ignore
+
+    try:
+        smtp = aiosmtplib.SMTP(hostname=_SMTP_HOST, port=_SMTP_PORT, start_tls=True)
+        await smtp.connect()
+        if _SMTP_USER and _SMTP_PASSWORD:
+            await smtp.login(_SMTP_USER, _SMTP_PASSWORD)
+        return smtp
+    except Exception as e:
+        print("SMTP connect error:", e)
+        return None
+
+
+async def _email_worker() -> None:
+    # Long-lived consumer: keeps a single SMTP connection open across sends
+    # instead of reconnecting per email. Delivery problems fall back to the
+    # console log so messages are never dropped and the worker keeps draining
+    smtp = await _smtp_connect() if _SMTP_HOST else None
+    try:
+        while True:
+            to_email, subject, content = await _email_queue.get()
+            try:
+                if smtp is None and _SMTP_HOST:
+                    smtp = await _smtp_connect()
+                if smtp is None:
+                    _log_email(to_email, subject, content)
+                    continue
+                message = EmailMessage()
+                message["From"] = _SMTP_FROM
+                message["To"] = to_email
+                message["Subject"] = subject
+                message.set_content(content)
+                try:
+                    await smtp.send_message(message)
+                except Exception as e:
+                    # SMTP servers drop idle connections; reconnect and retry
+                    # once before giving up on this message
+                    print("Email send error, reconnecting:", e)
+                    smtp = await _smtp_connect()
+                    if smtp is None:
+                        _log_email(to_email, subject, content)
+                    else:
+                        await smtp.send_message(message)
+            except Exception as e:
+                print("Email error:", e)
+                _log_email(to_email, subject, content)
+            finally:
+                _email_queue.task_done()
+    finally:
+        if smtp is not None:
+            await smtp.quit()
+
+
+@app.on_event("startup")
+async def _start_email_worker():
+    app.state.email_worker = asyncio.create_task(_email_worker())
+
+
+@app.on_event("shutdown")
+async def _stop_email_worker():
+    # Bound the drain so a wedged worker can't hang SIGTERM forever
+    try:
+        await asyncio.wait_for(_email_queue.join(), timeout=10)
+    except asyncio.TimeoutError:
+        print("Email queue drain timed out; cancelling worker")
+    app.state.email_worker.cancel()
+
+
+async def _send_confirmation_email(to_email: str, subject: str, content: str) -> None:
+    await _email_queue.put((to_email, subject, content))
+
+
+async def _mark_paid_and_email(oid: ObjectId, payload: CreateCheckoutPayload, total: int) -> None:
+    # Mock-mode completion: neither the update nor the email is needed to build
+    # the response, so this runs as a background task after it is sent
+    purchase_id = str(oid)
+    await db["prepaidcardpurchase"].update_one(
+        {"_id": oid},
+        {"$set": {"payment_status": "paid", "payment_reference": "mock-ok"}, "$currentDate": {"updated_at": True}},
+    )
+    await _send_confirmation_email(
+        to_email=payload.email,
+        subject="Confirmación de compra - Tarjeta Prepago",
+        content=(
+            f"Hola {payload.name},\n\nGracias por tu compra. Hemos recibido el pago de {total}€. "
+            f"Podrás recoger tu tarjeta en el local o solicitar envío según tu selección.\n\n"
+            f"ID de compra: {purchase_id}\n"
+            f"Método de entrega: {payload.delivery_method}\n\n"
+            "Gracias por elegirnos."
+        ),
+    )
+
+
+@app.post("/api/prepaid/create-checkout", response_model=None)
+async def create_checkout(payload: CreateCheckoutPayload, request: Request, background_tasks: BackgroundTasks) -> CheckoutResponse:
+    config = _CONFIG
+    if payload.amount not in _TOPUP_SET:
         raise HTTPException(status_code=400, detail="Monto de recarga no válido")
 
     total = config.card_issue_price + payload.amount
+    now = datetime.now(timezone.utc)
 
-    # Create purchase record (pending)
-    purchase = PrepaidCardPurchase(
+    # Create purchase record (pending); every field here is already validated
+    # via CreateCheckoutPayload or trusted, so skip the validator pipeline
+    purchase = PrepaidCardPurchase.model_construct(
         customer_name=payload.name,
         customer_email=payload.email,
         customer_phone=payload.phone,
@@ -119,40 +291,30 @@ def create_checkout(payload: CreateCheckoutPayload, request: Request):
         payment_provider=PAYMENT_PROVIDER,
         payment_status="pending",
         delivery_method=payload.delivery_method,
-        created_at=datetime.now(timezone.utc),
-        updated_at=datetime.now(timezone.utc),
+        created_at=now,
+        updated_at=now,
     )
-    purchase_id = create_document("prepaidcardpurchase", purchase)
+    # Generate the id client-side so the insert can run concurrently with the
+    # Stripe call instead of serializing in front of it
+    oid = ObjectId()
+    purchase_id = str(oid)
+    purchase_doc = purchase.model_dump()
+    purchase_doc["_id"] = oid
+    insert_task = asyncio.create_task(db["prepaidcardpurchase"].insert_one(purchase_doc))
 
-    success_url = os.getenv("FRONTEND_URL", "http://localhost:3000") + f"/exito?purchase_id={purchase_id}"
-    cancel_url = os.getenv("FRONTEND_URL", "http://localhost:3000") + f"/cancelado?purchase_id={purchase_id}"
+    success_url = _FRONTEND_URL + f"/exito?purchase_id={purchase_id}"
+    cancel_url = _FRONTEND_URL + f"/cancelado?purchase_id={purchase_id}"
 
     # Stripe mode
     if PAYMENT_PROVIDER == "stripe":
+        session = None
         try:
-            import stripe  # type: ignore
-            stripe.api_key = STRIPE_SECRET_KEY
-
-            line_items = [
-                {
-                    "price_data": {
-                        "currency": config.currency,
-                        "product_data": {"name": "Tarjeta Prepago - Emisión"},
-                        "unit_amount": config.card_issue_price * 100,
-                    },
-                    "quantity": 1,
-                },
-                {
-                    "price_data": {
-                        "currency": config.currency,
-                        "product_data": {"name": f"Recarga inicial {payload.amount}€"},
-                        "unit_amount": payload.amount * 100,
-                    },
-                    "quantity": 1,
-                },
-            ]
+            # Single line item with the combined total; the card/topup breakdown
+            # stays auditable via the session metadata
+            line_items = _LINE_ITEMS_CACHE[payload.amount]
 
-            session = stripe.checkout.Session.create(
+            session = await asyncio.to_thread(
+                stripe.checkout.Session.create,
                 mode="payment",
                 line_items=line_items,
                 customer_email=payload.email,
@@ -161,60 +323,59 @@ def create_checkout(payload: CreateCheckoutPayload, request: Request):
                     "customer_name": payload.name,
                     "customer_phone": payload.phone,
                     "delivery_method": payload.delivery_method,
+                    "card_price": str(config.card_issue_price),
+                    "topup_amount": str(payload.amount),
                 },
                 success_url=success_url + "&session_id={CHECKOUT_SESSION_ID}",
                 cancel_url=cancel_url,
             )
 
-            return CheckoutResponse(provider="stripe", url=session.url, purchase_id=purchase_id)
         except Exception as e:
             # Fallback to mock on any Stripe error
             print("Stripe error:", e)
 
-    # Mock mode: mark as paid immediately and return a confirmation URL
-    from bson import ObjectId  # type: ignore
-    db["prepaidcardpurchase"].update_one(
-        {"_id": ObjectId(purchase_id)},
-        {"$set": {"payment_status": "paid", "updated_at": datetime.now(timezone.utc), "payment_reference": "mock-ok"}},
-    )
+        if session is not None:
+            # Awaited outside the Stripe try so an insert failure surfaces as
+            # its own error instead of falling through to the mock branch
+            await insert_task
+            return CheckoutResponse(provider="stripe", url=session.url, purchase_id=purchase_id)
 
-    # Send confirmation email (log)
-    _send_confirmation_email(
-        to_email=payload.email,
-        subject="Confirmación de compra - Tarjeta Prepago",
-        content=(
-            f"Hola {payload.name},\n\nGracias por tu compra. Hemos recibido el pago de {total}€. "
-            f"Podrás recoger tu tarjeta en el local o solicitar envío según tu selección.\n\n"
-            f"ID de compra: {purchase_id}\n"
-            f"Método de entrega: {payload.delivery_method}\n\n"
-            "Gracias por elegirnos."
-        ),
-    )
+    # Mock mode: acknowledge immediately; the paid-update and confirmation
+    # email happen after the response goes out
+    await insert_task
+    background_tasks.add_task(_mark_paid_and_email, oid, payload, total)
 
     return CheckoutResponse(provider="mock", url=success_url, message="Pago simulado con éxito", purchase_id=purchase_id)
 
 
+# A confirmed payment is idempotent, so frontend polls/retries for the same
+# session can short-circuit without re-hitting Stripe and Mongo
+_CONFIRM_CACHE_TTL = 60.0
+_CONFIRM_CACHE_MAX = 1024
+_confirm_cache: dict[str, tuple[float, dict]] = {}
+
+
 @app.get("/api/prepaid/confirm")
-def confirm(session_id: Optional[str] = None, purchase_id: Optional[str] = None):
+async def confirm(session_id: Optional[str] = None, purchase_id: Optional[str] = None):
     # In Stripe mode, verify session and mark as paid
     if PAYMENT_PROVIDER == "stripe":
         if not session_id:
             raise HTTPException(status_code=400, detail="Falta session_id")
+        cached = _confirm_cache.get(session_id)
+        if cached is not None and time.monotonic() - cached[0] < _CONFIRM_CACHE_TTL:
+            return cached[1]
         try:
-            import stripe  # type: ignore
-            stripe.api_key = STRIPE_SECRET_KEY
-            session = stripe.checkout.Session.retrieve(session_id)
+            session = await asyncio.to_thread(stripe.checkout.Session.retrieve, session_id)
             pid = session.metadata.get("purchase_id") if session.metadata else purchase_id
             if session.payment_status == "paid" and pid:
-                from bson import ObjectId  # type: ignore
-                db["prepaidcardpurchase"].update_one(
+                await db["prepaidcardpurchase"].update_one(
                     {"_id": ObjectId(pid)},
-                    {"$set": {"payment_status": "paid", "payment_reference": session_id, "updated_at": datetime.now(timezone.utc)}},
+                    {"$set": {"payment_status": "paid", "payment_reference": session_id}, "$currentDate": {"updated_at": True}},
                 )
                 email = session.customer_details.email if session.customer_details else None
                 name = session.metadata.get("customer_name") if session.metadata else "Cliente"
                 if email:
-                    _send_confirmation_email(
+                    await _send_confirmation_email(
                         to_email=email,
                         subject="Confirmación de compra - Tarjeta Prepago",
                         content=(
@@ -223,7 +384,11 @@ def confirm(session_id: Optional[str] = None, purchase_id: Optional[str] = None)
                             "Te enviaremos instrucciones para recoger tu tarjeta en el local o envío.\n\nGracias."
                         ),
                     )
-                return {"status": "ok", "purchase_id": pid}
+                result = {"status": "ok", "purchase_id": pid}
+                if len(_confirm_cache) >= _CONFIRM_CACHE_MAX:
+                    _confirm_cache.pop(next(iter(_confirm_cache)))
+                _confirm_cache[session_id] = (time.monotonic(), result)
+                return result
             else:
                 raise HTTPException(status_code=400, detail="Pago no confirmado")
         except Exception as e:
@@ -238,4 +403,13 @@ def confirm(session_id: Optional[str] = None, purchase_id: Optional[str] = None)
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        log_level="warning",
+    )
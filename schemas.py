@@ -11,7 +11,7 @@ Model name is converted to lowercase for the collection name:
 - BlogPost -> "blogs" collection
 """
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
 from typing import Optional, Literal
 from datetime import datetime
 
@@ -31,6 +31,13 @@ class PrepaidCardPurchase(BaseModel):
     Registro de compras de tarjeta prepago
     Collection name: "prepaidcardpurchase"
     """
+    model_config = ConfigDict(
+        validate_assignment=False,
+        extra="ignore",
+        str_strip_whitespace=True,
+        str_max_length=256,
+    )
+
     customer_name: str = Field(..., description="Nombre del cliente")
     customer_email: EmailStr = Field(..., description="Email del cliente")
     customer_phone: str = Field(..., description="Teléfono del cliente")